@@ -1,19 +1,25 @@
+import logging
 import os.path
-import sys
 from enum import auto, Enum
-from itertools import groupby
+from itertools import groupby, pairwise
 from string import digits
-from typing import Iterable, NamedTuple, Optional, TypeVar, Tuple
+from typing import NamedTuple, Optional, Tuple
 
 import cv2
 import numpy as np
 from PIL import Image, ImageGrab
 
 
+logger = logging.getLogger(__name__)
+
 RED = (0, 0, 0xFF)
 BLUE = (0, 0xFF, 0)
 
-T = TypeVar("T")
+# Downsampling factor for finding the number areas
+AREAS_SCALE = 4
+# Structuring elements joining the cells of the number areas
+AREAS_DILATE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (10, 10))
+AREAS_ERODE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (8, 8))
 
 
 class Rect(NamedTuple):
@@ -43,7 +49,18 @@ class DigitOCR:
             self.x_broders.append((r1.x + r1.w - 1 + r2.x) // 2)
         self.x_broders.append(w - 1)
 
+        # Crops of the same glyph repeat a lot on a board, so the digits are cached by the crop contents
+        self.cache: dict[Tuple[int, int, bytes], int] = {}
+
     def recognize(self, img: np.ndarray) -> int:
+        h, w, *_ = img.shape
+        key = (h, w, img.tobytes())
+        digit = self.cache.get(key)
+        if digit is None:
+            digit = self.cache[key] = self.do_recognize(img)
+        return digit
+
+    def do_recognize(self, img: np.ndarray) -> int:
         h, w, *_ = img.shape
         new_w = self.char_height * w  // h
         img = cv2.resize(img, (new_w, self.char_height))
@@ -61,21 +78,6 @@ class DigitOCR:
         raise ValueError(f"Invalid x coordinate: {x}")
 
 
-def pairwise(coll: Iterable[T]) -> Iterable[Tuple[T, T]]:
-    it = iter(coll)
-    try:
-        prev = next(it)
-    except StopIteration:
-        return
-    while True:
-        try:
-            curr = next(it)
-        except StopIteration:
-            return
-        yield prev, curr
-        prev = curr
-
-
 def print_img(img: np.ndarray):
     assert len(img.shape) == 2
     for line in img:
@@ -88,12 +90,18 @@ def get_contour_rects(img: np.ndarray) -> list[Rect]:
 
 
 def get_number_areas(img: np.ndarray) -> Tuple[Rect, Rect]:
-    s_img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[:, :, 1]
-    s_img = cv2.dilate(s_img, np.ones((10, 10)))
-    s_img = cv2.erode(s_img, np.ones((8, 8)))
+    s_img = cv2.extractChannel(cv2.cvtColor(img, cv2.COLOR_BGR2HSV), 1)
+    s_img = cv2.dilate(s_img, AREAS_DILATE_KERNEL)
+    s_img = cv2.erode(s_img, AREAS_ERODE_KERNEL)
     _, s_img = cv2.threshold(s_img, 40, 255, cv2.THRESH_BINARY)
 
-    rects = get_contour_rects(s_img)
+    # The areas are large blobs, so their contours are traced on a downsampled copy first; if they are too close
+    # to be told apart there, the full image is used
+    rects = get_contour_rects(s_img[::AREAS_SCALE, ::AREAS_SCALE])
+    if len(rects) == 2:
+        rects = [upscale_rect(s_img, r, AREAS_SCALE) for r in rects]
+    if len(rects) != 2 or rects_intersect(*rects):
+        rects = get_contour_rects(s_img)
     if len(rects) != 2:
         raise RuntimeError(f"Cannot determine number areas, got {len(rects)} contours")
     rects.sort(key=lambda r: r.w)
@@ -101,45 +109,52 @@ def get_number_areas(img: np.ndarray) -> Tuple[Rect, Rect]:
     return row_numbers_rect, col_numbers_rect
 
 
+def upscale_rect(img: np.ndarray, rect: Rect, scale: int) -> Rect:
+    # Pixels of the downsampled copy may be up to `scale` pixels away from the blob edges, so the exact rect is
+    # measured on the full image around them
+    x = max((rect.x - 1) * scale, 0)
+    y = max((rect.y - 1) * scale, 0)
+    blob_img = img[y:(rect.y + rect.h + 1) * scale, x:(rect.x + rect.w + 1) * scale]
+    blob_x, blob_y, w, h = cv2.boundingRect(blob_img)
+    return Rect(x + blob_x, y + blob_y, w, h)
+
+
+def rects_intersect(r1: Rect, r2: Rect) -> bool:
+    return r1.x < r2.x + r2.w and r2.x < r1.x + r1.w and r1.y < r2.y + r2.h and r2.y < r1.y + r1.h
+
+
 def extract_rect(img: np.ndarray, rect: Rect) -> np.ndarray:
     return img[rect.y:rect.y + rect.h, rect.x:rect.x + rect.w]
 
 
 def cluster_1d(vec: list[int]) -> dict[int, int]:
-    max_gap = max(x2 - x1 for x1, x2 in pairwise(vec))
-    result = {vec[0]: 0}
-    cluster_idx = 0
-    prev = vec[0]
-    for x in vec[1:]:
-        if (x - prev) * 2 > max_gap:
-            cluster_idx += 1
-        result[x] = cluster_idx
-        prev = x
-    return result
+    coords = np.asarray(vec)
+    gaps = np.diff(coords)
+    # A new cluster starts after every gap longer than half of the longest one
+    cluster_idxs = np.concatenate(([0], np.cumsum(gaps * 2 > gaps.max())))
+    return dict(zip(coords.tolist(), cluster_idxs.tolist()))
 
 
-def find_number_rects(img: np.ndarray, direction: Direction) -> list[list[[Rect]]]:
+def find_number_rects(cells_img: np.ndarray, direction: Direction) -> list[list[[Rect]]]:
     def line_coord(r: Rect):
         return r.x if direction is Direction.cols else r.y
 
     def other_coord(r: Rect):
         return r.x if direction is Direction.rows else r.y
 
-    _, img = cv2.threshold(img, 0xB0, 0xFF, cv2.THRESH_BINARY)
-    conts, _  = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    conts, _  = cv2.findContours(cells_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     rects: list[Rect] = []
     for cont in conts:
         rect = Rect(*cv2.boundingRect(cont))
         if cv2.contourArea(cont) and 0.9 < rect.w / rect.h < 1.1 and rect.w * rect.h / cv2.contourArea(cont) < 1.5:
             rects.append(rect)
-        else:
-            print(
-                "Skipped contour",
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Skipped contour %s %s %s",
                 cv2.contourArea(cont),
                 rect.w / rect.h,
                 rect.w * rect.h / (cv2.contourArea(cont) + 0.1),
-                file=sys.stderr
             )
 
     line_map = cluster_1d(sorted({line_coord(r) for r in rects}))
@@ -154,11 +169,21 @@ def find_number_rects(img: np.ndarray, direction: Direction) -> list[list[[Rect]
     return result
 
 
-def parse_cell(img: np.ndarray, ocr: DigitOCR, debug: bool) -> Optional[int]:
-    rects = get_contour_rects(img)
+def get_glyph_rects(img: np.ndarray) -> list[Rect]:
+    # Glyphs are separated by blank columns, so they are found from the column projection, left to right
+    ink_cols = np.concatenate(([0], img.any(axis=0).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(ink_cols))
+    rects = []
+    for x1, x2 in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        ink_rows = np.flatnonzero(img[:, x1:x2].any(axis=1))
+        rects.append(Rect(x1, int(ink_rows[0]), x2 - x1, int(ink_rows[-1] - ink_rows[0]) + 1))
+    return rects
+
+
+def parse_cell(img: np.ndarray, ocr: DigitOCR) -> Optional[int]:
+    rects = get_glyph_rects(img)
     if not rects:
         return None
-    rects.sort(key=lambda r: r.x)
     result = 0
     for rect in rects:
         digit_img = extract_rect(img, rect)
@@ -168,13 +193,21 @@ def parse_cell(img: np.ndarray, ocr: DigitOCR, debug: bool) -> Optional[int]:
 
 def parse_numbers(img: np.ndarray, direction: Direction, ocr: DigitOCR) -> list[list[int]]:
     img = cv2.cvtColor(img,  cv2.COLOR_BGR2GRAY)
-    rects = find_number_rects(img, direction)
+    # Light cells and dark digits are separated at different levels
+    _, cells_img = cv2.threshold(img, 0xB0, 0xFF, cv2.THRESH_BINARY)
+    rects = find_number_rects(cells_img, direction)
     _, img = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY_INV)
+    # Cells with the same number are mostly rendered identically, so every distinct cell image is parsed once
+    cell_values: dict[Tuple[int, int, bytes], Optional[int]] = {}
     result = []
-    for l_idx, line in enumerate(rects):
+    for line in rects:
         result_line = []
-        for r_idx, rect in enumerate(line):
-            value = parse_cell(extract_rect(img, rect), ocr, l_idx == 23 and r_idx == 5)
+        for rect in line:
+            cell_img = extract_rect(img, rect)
+            key = (rect.w, rect.h, cell_img.tobytes())
+            if key not in cell_values:
+                cell_values[key] = parse_cell(cell_img, ocr)
+            value = cell_values[key]
             if value is not None:
                 result_line.append(value)
         result.append(result_line)
@@ -188,7 +221,7 @@ def read_image(fname: Optional[str]):
         pil_img = Image.open(fname)
     else:
         pil_img = ImageGrab.grabclipboard()
-    img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+    img = cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
     row_numbers_rect, col_numbers_rect = get_number_areas(img)
 
     return {
@@ -13,6 +13,8 @@ struct Cli {
     max_depth: usize,
     #[arg(short, long)]
     find_all: bool,
+    #[arg(short, long, default_value_t = 1, help("Number of threads for line sweeps"))]
+    jobs: usize,
 }
 
 fn main() {
@@ -20,7 +22,8 @@ fn main() {
     let solver = match cli.fname {
         Some(fname) => Solver::from_reader(std::fs::File::open(fname).unwrap(), cli.max_depth, cli.find_all).unwrap(),
         None => Solver::from_reader(io::stdin(), cli.max_depth, cli.find_all).expect("Malformed input"),
-    };
+    }
+    .with_jobs(cli.jobs);
     let start = Instant::now();
     match solver.solve() {
         Solved(fields) => {
@@ -1,15 +1,16 @@
 use ahash::AHasher;
 use assumption::Assumption;
-use common::{CellValue, LineHints, Unknown, KNOWN};
+use common::{LineHints, Unknown, KNOWN};
 use field::Field;
 use itertools::Itertools;
-use line::{Line, LineCache, LineType};
+use line::{Line, LineBuffers, LineCache, LineChange, LineSolution, LineType};
 use std::borrow::Cow;
 use std::cell::RefCell;
-use std::collections::HashMap;
+use std::collections::{HashMap, HashSet};
 use std::hash::BuildHasherDefault;
 use std::io;
 use std::ops::DerefMut;
+use std::thread;
 use InternalSolution::*;
 use LineType::*;
 
@@ -33,6 +34,9 @@ enum InternalSolution {
 
 type ABuildHasher = BuildHasherDefault<AHasher>;
 
+/// Minimal number of lines per thread worth spawning it; solving a single line is much cheaper than that.
+const MIN_LINES_PER_JOB: usize = 32;
+
 #[derive(serde::Deserialize)]
 struct NonoDescription {
     row_hints: Vec<LineHints>,
@@ -42,11 +46,15 @@ struct NonoDescription {
 pub struct Solver {
     row_hints: Vec<LineHints>,
     col_hints: Vec<LineHints>,
-    row_cache: Vec<LineCache<ABuildHasher>>,
-    col_cache: Vec<LineCache<ABuildHasher>>,
+    /// Lines with the same hints and length share a cache, as their solutions only depend on the cells.
+    line_caches: Vec<LineCache<ABuildHasher>>,
+    row_cache_idxs: Vec<usize>,
+    col_cache_idxs: Vec<usize>,
+    line_buffers: RefCell<LineBuffers>,
     max_depth: usize,
     find_all: bool,
-    pub solutions: RefCell<HashMap<Vec<CellValue>, Field>>,
+    jobs: usize,
+    pub solutions: RefCell<HashSet<Field>>,
 }
 
 impl Solver {
@@ -56,10 +64,41 @@ impl Solver {
     }
 
     fn from_hints(row_hints: Vec<LineHints>, col_hints: Vec<LineHints>, max_depth: usize, find_all: bool) -> Self {
-        let row_cache = (0..row_hints.len()).map(|_| RefCell::new(HashMap::default())).collect();
-        let col_cache = (0..col_hints.len()).map(|_| RefCell::new(HashMap::default())).collect();
-        let solutions = RefCell::new(HashMap::new());
-        Self { row_hints, col_hints, row_cache, col_cache, max_depth, find_all, solutions }
+        let mut cache_idxs: HashMap<(&LineHints, usize), usize> = HashMap::new();
+        let mut cache_idx = |hints, len| {
+            let idx = cache_idxs.len();
+            *cache_idxs.entry((hints, len)).or_insert(idx)
+        };
+        let row_cache_idxs = row_hints
+            .iter()
+            .map(|hints| cache_idx(hints, col_hints.len()))
+            .collect();
+        let col_cache_idxs = col_hints
+            .iter()
+            .map(|hints| cache_idx(hints, row_hints.len()))
+            .collect();
+        let line_caches = (0..cache_idxs.len())
+            .map(|_| RefCell::new(HashMap::default()))
+            .collect();
+        let line_buffers = RefCell::new(LineBuffers::default());
+        let solutions = RefCell::new(HashSet::new());
+        Self {
+            row_hints,
+            col_hints,
+            line_caches,
+            row_cache_idxs,
+            col_cache_idxs,
+            line_buffers,
+            max_depth,
+            find_all,
+            jobs: 1,
+            solutions,
+        }
+    }
+
+    /// Sets the number of threads solving the lines of each sweep.
+    pub fn with_jobs(self, jobs: usize) -> Self {
+        Self { jobs: jobs.max(1), ..self }
     }
 
     pub fn create_field(&self) -> Field {
@@ -75,11 +114,11 @@ impl Solver {
     }
 
     fn row_line<'a>(&'a self, field: &'a Field, row_idx: usize) -> Line {
-        Line::new(Row, row_idx, &self.row_hints[row_idx], field.row(row_idx))
+        Line::new(&self.row_hints[row_idx], field.row(row_idx)).with_masks(field.row_masks(row_idx))
     }
 
     fn col_line<'a>(&'a self, field: &'a Field, col_idx: usize) -> Line {
-        Line::new(Col, col_idx, &self.col_hints[col_idx], field.col(col_idx))
+        Line::new(&self.col_hints[col_idx], field.col(col_idx)).with_masks(field.col_masks(col_idx))
     }
 
     fn line<'a>(&'a self, field: &'a Field, line_type: LineType, line_idx: usize) -> Line {
@@ -91,9 +130,48 @@ impl Solver {
 
     fn cache(&self, line_type: LineType, line_idx: usize) -> &LineCache<ABuildHasher> {
         match line_type {
-            Row => &self.row_cache[line_idx],
-            Col => &self.col_cache[line_idx],
+            Row => &self.line_caches[self.row_cache_idxs[line_idx]],
+            Col => &self.line_caches[self.col_cache_idxs[line_idx]],
+        }
+    }
+
+    /// Solves the lines, splitting the ones missing from the caches between `jobs` threads.
+    ///
+    /// The lines of the same type don't share cells, so they can be solved independently; the caches are only
+    /// accessed from the calling thread.
+    fn solve_lines_in_parallel(&self, field: &Field, line_type: LineType, line_idxs: &[usize]) -> Vec<LineSolution> {
+        let lines: Vec<Line> = line_idxs.iter().map(|&idx| self.line(field, line_type, idx)).collect();
+        let mut solutions: Vec<Option<LineSolution>> = line_idxs
+            .iter()
+            .zip(&lines)
+            .map(|(&idx, line)| line.cached(self.cache(line_type, idx)))
+            .collect();
+        let missing: Vec<usize> = (0..lines.len()).filter(|&i| solutions[i].is_none()).collect();
+        let results: Vec<Option<Vec<LineChange>>> = if missing.len() < 2 * MIN_LINES_PER_JOB {
+            let mut buffers = self.line_buffers.borrow_mut();
+            missing.iter().map(|&i| lines[i].do_solve(&mut buffers)).collect()
+        } else {
+            thread::scope(|scope| {
+                let handles: Vec<_> = missing
+                    .chunks(missing.len().div_ceil(self.jobs).max(MIN_LINES_PER_JOB))
+                    .map(|chunk| {
+                        let lines = &lines;
+                        scope.spawn(move || {
+                            let mut buffers = LineBuffers::default();
+                            chunk
+                                .iter()
+                                .map(|&i| lines[i].do_solve(&mut buffers))
+                                .collect::<Vec<_>>()
+                        })
+                    })
+                    .collect();
+                handles.into_iter().flat_map(|handle| handle.join().unwrap()).collect()
+            })
+        };
+        for (i, result) in missing.into_iter().zip(results) {
+            solutions[i] = Some(lines[i].store(self.cache(line_type, line_idxs[i]), result));
         }
+        solutions.into_iter().map(Option::unwrap).collect()
     }
 
     fn do_solve_by_lines_step(
@@ -103,19 +181,26 @@ impl Solver {
         line_changes: &[u8],
     ) -> Option<Vec<Assumption>> {
         let mut all_changes: Vec<Assumption> = Vec::new();
-        for line_idx in line_changes
+        let line_idxs: Vec<usize> = line_changes
             .iter()
             .enumerate()
             .filter(|(_, &val)| val > 0)
             .map(|(idx, _)| idx)
-        {
-            let mut line = self.line(&field, line_type, line_idx);
-            match line.solve(self.cache(line_type, line_idx)).as_ref() {
-                Some(changes) if !changes.is_empty() => {
-                    apply_changes(changes, field.to_mut(), &mut all_changes);
+            .collect();
+        if self.jobs > 1 && line_idxs.len() >= 2 * MIN_LINES_PER_JOB {
+            let solutions = self.solve_lines_in_parallel(field, line_type, &line_idxs);
+            for (line_idx, solution) in line_idxs.into_iter().zip(solutions) {
+                if !apply_line_solution(&solution, line_type, line_idx, field, &mut all_changes) {
+                    return None;
+                }
+            }
+        } else {
+            for line_idx in line_idxs {
+                let line = self.line(field, line_type, line_idx);
+                let solution = line.solve(self.cache(line_type, line_idx), &mut self.line_buffers.borrow_mut());
+                if !apply_line_solution(&solution, line_type, line_idx, field, &mut all_changes) {
+                    return None;
                 }
-                None => return None,
-                _ => (),
             }
         }
         Some(all_changes)
@@ -213,7 +298,8 @@ impl Solver {
     }
 
     fn do_solve(&self, field: &Field, max_depth: usize, changed_rows: &[u8], changed_cols: &[u8]) -> InternalSolution {
-        let mut field = field.clone();
+        // Most of the probes are made with max_depth 0 and never change the field, so it's copied only when needed.
+        let mut field = Cow::Borrowed(field);
         let mut all_changes = Vec::new();
         let mut changed_rows = Cow::Borrowed(changed_rows);
         let mut changed_cols = Cow::Borrowed(changed_cols);
@@ -226,7 +312,7 @@ impl Solver {
                     if max_depth == 0 {
                         return Unsolved(changes);
                     }
-                    apply_changes(&changes, &mut field, &mut all_changes);
+                    apply_changes(&changes, field.to_mut(), &mut all_changes);
                 }
             }
 
@@ -238,7 +324,7 @@ impl Solver {
                     Solved | Controversial => return by_step,
                     Unsolved(changes) => {
                         if !changes.is_empty() {
-                            apply_changes(&changes, &mut field, &mut all_changes);
+                            apply_changes(&changes, field.to_mut(), &mut all_changes);
                             for ass in changes {
                                 changed_rows.to_mut()[ass.coords.0] += 1;
                                 changed_cols.to_mut()[ass.coords.1] += 1;
@@ -260,7 +346,7 @@ impl Solver {
             &vec![1; self.ncols()],
         ) {
             Controversial => Solution::Controversial,
-            Solved => Solution::Solved(self.solutions.borrow().iter().map(|(_, fld)| fld.clone()).collect()),
+            Solved => Solution::Solved(self.solutions.take().into_iter().collect()),
             Unsolved(changes) => {
                 let mut fld = self.create_field();
                 changes.iter().for_each(|ass| ass.apply(&mut fld));
@@ -270,6 +356,29 @@ impl Solver {
     }
 }
 
+/// Applies the changes found by solving a line; returns false if the line was controversial.
+fn apply_line_solution(
+    solution: &LineSolution,
+    line_type: LineType,
+    line_idx: usize,
+    field: &mut Cow<Field>,
+    all_changes: &mut Vec<Assumption>,
+) -> bool {
+    match solution.as_ref() {
+        Some(changes) if !changes.is_empty() => {
+            let field = field.to_mut();
+            for &(idx, val) in changes {
+                let ass = Assumption { coords: line_type.coords(line_idx, idx), val };
+                ass.apply(field);
+                all_changes.push(ass);
+            }
+        }
+        None => return false,
+        _ => (),
+    }
+    true
+}
+
 fn apply_changes(changes: &[Assumption], field: &mut Field, all_changes: &mut Vec<Assumption>) {
     all_changes.extend_from_slice(&changes);
     changes.iter().for_each(|ass| ass.apply(field));
@@ -311,6 +420,26 @@ mod tests {
         "]);
     }
 
+    #[test]
+    fn share_line_caches() {
+        let solver = Solver::from_hints(
+            vec![vec![1], vec![2], vec![1]],
+            vec![vec![1], vec![2], vec![1]],
+            0,
+            false,
+        );
+        assert_eq!(solver.line_caches.len(), 2);
+        assert_eq!(solver.row_cache_idxs, solver.col_cache_idxs);
+        let solver = Solver::from_hints(vec![vec![1]; 2], vec![vec![1]; 3], 0, false);
+        assert_eq!(solver.line_caches.len(), 2);
+    }
+
+    #[test]
+    fn solve_by_line_in_parallel() {
+        let solver = Solver::from_hints(vec![vec![2]; 64], vec![vec![64]; 2], 0, false).with_jobs(2);
+        solver.solve().assert_solved(&[&"##\n".repeat(64)]);
+    }
+
     #[test]
     fn solve_ambiguous() {
         let solver = Solver::from_hints(vec![vec![1], vec![1]], vec![vec![1], vec![1]], 3, true);
@@ -11,17 +11,22 @@ pub const KNOWN: [CellValue; 2] = [Filled, Empty];
 
 pub type LineHints = Vec<usize>;
 
+/// Filled and empty cells of a line as bit masks; only kept for lines that fit into a word.
+pub type LineMasks = (u64, u64);
+
 pub fn line_to_str(line: &[CellValue]) -> String {
-    line.iter()
-        .map(|&x| match x {
+    line.iter().copied().map(CellValue::to_char).collect()
+}
+
+impl CellValue {
+    pub fn to_char(self) -> char {
+        match self {
             Unknown => '~',
             Filled => '#',
             Empty => '.',
-        })
-        .collect()
-}
+        }
+    }
 
-impl CellValue {
     pub fn invert(&self) -> Self {
         match self {
             Filled => Empty,
@@ -1,27 +1,39 @@
-use super::common::{line_to_str, CellValue, Unknown};
-use std::collections::HashMap;
+use super::common::{CellValue, Empty, Filled, LineMasks, Unknown};
+use std::collections::HashSet;
 use std::fmt::Display;
 
+/// Nonogram field, stored both row-major and column-major so that every line is a contiguous slice.
 #[derive(Clone, Eq, PartialEq, Hash, Debug)]
 pub struct Field {
     nrows: usize,
     ncols: usize,
     rows: Vec<CellValue>,
     cols: Vec<CellValue>,
+    row_masks: Vec<LineMasks>,
+    col_masks: Vec<LineMasks>,
 }
 
 impl Display for Field {
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        let mut result = String::with_capacity(self.nrows * (self.ncols + 1));
         for row_idx in 0..self.nrows {
-            writeln!(f, "{}", line_to_str(self.row(row_idx)))?;
+            result.extend(self.row(row_idx).iter().copied().map(CellValue::to_char));
+            result.push('\n');
         }
-        Ok(())
+        f.write_str(&result)
     }
 }
 
 impl Field {
     pub fn new(nrows: usize, ncols: usize) -> Self {
-        Self { nrows, ncols, rows: vec![Unknown; nrows * ncols], cols: vec![Unknown; nrows * ncols] }
+        Self {
+            nrows,
+            ncols,
+            rows: vec![Unknown; nrows * ncols],
+            cols: vec![Unknown; nrows * ncols],
+            row_masks: new_masks(nrows, ncols),
+            col_masks: new_masks(ncols, nrows),
+        }
     }
 
     pub fn is_solved(&self) -> bool {
@@ -36,6 +48,14 @@ impl Field {
         &self.cols[idx * self.nrows..(idx + 1) * self.nrows]
     }
 
+    pub fn row_masks(&self, idx: usize) -> Option<LineMasks> {
+        self.row_masks.get(idx).copied()
+    }
+
+    pub fn col_masks(&self, idx: usize) -> Option<LineMasks> {
+        self.col_masks.get(idx).copied()
+    }
+
     pub fn get(&self, coords: (usize, usize)) -> CellValue {
         let (row_idx, col_idx) = coords;
         self.rows[row_idx * self.ncols + col_idx]
@@ -45,11 +65,32 @@ impl Field {
         let (row_idx, col_idx) = coords;
         self.rows[row_idx * self.ncols + col_idx] = val;
         self.cols[col_idx * self.nrows + row_idx] = val;
+        if let Some(masks) = self.row_masks.get_mut(row_idx) {
+            set_mask_bit(masks, col_idx, val);
+        }
+        if let Some(masks) = self.col_masks.get_mut(col_idx) {
+            set_mask_bit(masks, row_idx, val);
+        }
     }
 
-    pub fn store_solution(&self, solutions: &mut HashMap<Vec<CellValue>, Field>) {
-        if !solutions.contains_key(&self.rows) {
-            solutions.insert(self.rows.clone(), self.clone());
+    pub fn store_solution(&self, solutions: &mut HashSet<Field>) {
+        if !solutions.contains(self) {
+            solutions.insert(self.clone());
         }
     }
 }
+
+/// Masks are kept only if the lines fit into a word; otherwise there are none.
+fn new_masks(nlines: usize, line_len: usize) -> Vec<LineMasks> {
+    if line_len <= u64::BITS as usize {
+        vec![(0, 0); nlines]
+    } else {
+        Vec::new()
+    }
+}
+
+fn set_mask_bit(masks: &mut LineMasks, idx: usize, val: CellValue) {
+    let bit = 1 << idx;
+    masks.0 = masks.0 & !bit | if val == Filled { bit } else { 0 };
+    masks.1 = masks.1 & !bit | if val == Empty { bit } else { 0 };
+}
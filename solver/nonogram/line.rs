@@ -1,10 +1,8 @@
-use super::assumption::Assumption;
-use super::common::{line_to_str, CellValue, LineHints};
-use crate::nonogram::common::KNOWN;
-use std::borrow::Cow;
+use super::common::{line_to_str, CellValue, LineHints, LineMasks};
 use std::cell::RefCell;
 use std::collections::HashMap;
 use std::hash::BuildHasher;
+use std::mem;
 use std::rc::Rc;
 use CellValue::*;
 use LineType::*;
@@ -12,8 +10,11 @@ use LineType::*;
 #[cfg(test)]
 mod tests;
 
-pub type LineCache<S> = RefCell<HashMap<Vec<CellValue>, LineSolution, S>>;
-pub type LineSolution = Rc<Option<Vec<Assumption>>>;
+pub type LineCache<S> = RefCell<HashMap<LineKey, LineSolution, S>>;
+pub type LineSolution = Rc<Option<Vec<LineChange>>>;
+
+/// Index of a cell in the line with the value deduced for it; the same for every line with the same hints and cells.
+pub type LineChange = (usize, CellValue);
 
 #[derive(Hash, Eq, PartialEq, Copy, Clone, Debug)]
 pub enum LineType {
@@ -28,126 +29,351 @@ impl LineType {
             Col => Row,
         }
     }
+
+    /// Returns the field coordinates of cell `idx` of line `line_idx`.
+    pub fn coords(&self, line_idx: usize, idx: usize) -> (usize, usize) {
+        match *self {
+            Row => (line_idx, idx),
+            Col => (idx, line_idx),
+        }
+    }
 }
 
 pub struct Line<'a> {
-    line_type: LineType,
-    line_idx: usize,
     hints: &'a LineHints,
-    cells: Cow<'a, [CellValue]>,
+    cells: &'a [CellValue],
+    masks: Option<LineMasks>,
 }
 
 impl<'a> Line<'a> {
-    pub fn new(line_type: LineType, line_idx: usize, hints: &'a LineHints, cells: &'a [CellValue]) -> Self {
-        Self { line_type, line_idx, hints, cells: Cow::from(cells) }
+    pub fn new(hints: &'a LineHints, cells: &'a [CellValue]) -> Self {
+        Self { hints, cells, masks: None }
+    }
+
+    /// Provides the cell masks kept by the field, so that they aren't recomputed for the cache key.
+    pub fn with_masks(self, masks: Option<LineMasks>) -> Self {
+        Self { masks, ..self }
+    }
+
+    fn key(&self) -> LineKey {
+        match self.masks {
+            Some((filled, empty)) => {
+                let key = LineKey::Masks(filled, empty);
+                debug_assert!(key == LineKey::new(self.cells));
+                key
+            }
+            None => LineKey::new(self.cells),
+        }
     }
 
     #[allow(dead_code)]
     fn to_string(&self) -> String {
-        line_to_str(&self.cells)
+        line_to_str(self.cells)
     }
 
-    fn do_verify(&self, hint_idx: usize, cells_offset: usize, last_filled: Option<usize>) -> bool {
-        if cells_offset >= self.cells.len() {
-            return hint_idx == self.hints.len();
+    /// Checks if the hints can still be placed on the line.
+    #[cfg(test)]
+    fn verify(&self) -> bool {
+        let mut head = vec![false; (self.cells.len() + 1) * (self.hints.len() + 1)];
+        if fits_word(self.cells) {
+            self.fill_head(&mut head, &EmptyMask::new(self.cells))
+        } else {
+            self.fill_head(&mut head, &EmptyCounts::new(self.cells, Vec::new()))
         }
-        let cells = &self.cells[cells_offset..];
-        if hint_idx == self.hints.len() {
-            return last_filled.map_or(true, |lf| cells_offset > lf);
+    }
+
+    /// Fills `head[i * (nhints + 1) + j]`, which tells if the first `j` hints fit into the first `i` cells,
+    /// covering all the filled cells among them.
+    ///
+    /// Returns true if all the hints fit into the line.
+    fn fill_head<E: EmptyCells>(&self, head: &mut [bool], empties: &E) -> bool {
+        let size = self.cells.len();
+        let nhints = self.hints.len();
+        let width = nhints + 1;
+
+        head[0] = true;
+        for i in 1..=size {
+            for j in 0..=nhints {
+                let skipped = self.cells[i - 1] != Filled && head[(i - 1) * width + j];
+                let placed = j > 0 && {
+                    let hint = self.hints[j - 1];
+                    hint <= i
+                        && !empties.any_in(i - hint, i)
+                        && if hint == i {
+                            j == 1
+                        } else {
+                            self.cells[i - hint - 1] != Filled && head[(i - hint - 1) * width + j - 1]
+                        }
+                };
+                head[i * width + j] = skipped || placed;
+            }
         }
-        let current_hint = self.hints[hint_idx];
-        let size = cells.len();
+        head[size * width + nhints]
+    }
 
-        if current_hint > size {
-            return false;
+    /// Fills `tail[i * (nhints + 1) + j]`, which tells if the hints starting from `j` fit into the cells starting
+    /// from `i`, covering all the filled cells among them.
+    ///
+    /// Also fills `starts[i * nhints + j]`, which tells if hint `j` can start at cell `i` with the following hints
+    /// fitting after it.
+    fn fill_tail<E: EmptyCells>(&self, tail: &mut [bool], starts: &mut [bool], empties: &E) {
+        let size = self.cells.len();
+        let nhints = self.hints.len();
+        let width = nhints + 1;
+
+        tail[size * width + nhints] = true;
+        for i in (0..size).rev() {
+            for j in 0..=nhints {
+                let skipped = self.cells[i] != Filled && tail[(i + 1) * width + j];
+                let placed = j < nhints && self.fits_after(tail, empties, j, i);
+                if placed {
+                    starts[i * nhints + j] = true;
+                }
+                tail[i * width + j] = skipped || placed;
+            }
         }
-        for (start, &val) in cells[..size - current_hint + 1].iter().enumerate() {
-            let end = start + current_hint;
-            if cells[start..end].iter().all(|&x| x != Empty)
-                && (end == size || cells[end] != Filled)
-                && self.do_verify(hint_idx + 1, cells_offset + end + 1, last_filled)
-            {
-                return true;
+    }
+
+    /// Tells if hint `hint_idx` can be placed at `start`, with the following hints fitting after it.
+    fn fits_after<E: EmptyCells>(&self, tail: &[bool], empties: &E, hint_idx: usize, start: usize) -> bool {
+        let size = self.cells.len();
+        let end = start + self.hints[hint_idx];
+        end <= size
+            && !empties.any_in(start, end)
+            && if end == size {
+                hint_idx + 1 == self.hints.len()
+            } else {
+                self.cells[end] != Filled && tail[(end + 1) * (self.hints.len() + 1) + hint_idx + 1]
             }
+    }
+
+    /// Checks a fully known line by comparing its runs of filled cells with the hints in a single pass.
+    fn runs_match_hints(&self) -> bool {
+        if let Some((filled, _)) = self.masks {
+            return mask_runs_match_hints(filled, self.hints);
+        }
+        let mut hints = self.hints.iter();
+        let mut run = 0;
+        for &val in self.cells.iter().chain(&[Empty]) {
             if val == Filled {
-                return false;
+                run += 1;
+            } else if run > 0 {
+                if hints.next() != Some(&run) {
+                    return false;
+                }
+                run = 0;
             }
         }
-        false
+        hints.next().is_none()
     }
 
-    fn verify(&self, last_filled: Option<usize>) -> bool {
-        self.do_verify(0, 0, last_filled)
-    }
+    /// Finds the cells that are the same in every valid placement of the hints.
+    pub fn do_solve(&self, buffers: &mut LineBuffers) -> Option<Vec<LineChange>> {
+        let size = self.cells.len();
+        let nhints = self.hints.len();
 
-    fn get_coords(&self, idx: usize) -> (usize, usize) {
-        match self.line_type {
-            Row => (self.line_idx, idx),
-            Col => (idx, self.line_idx),
+        // Hints packed as tightly as possible; every hint can be shifted by at most `slack` from there.
+        let min_size = self.hints.iter().sum::<usize>() + nhints.saturating_sub(1);
+        if min_size > size {
+            return None;
         }
-    }
+        let slack = size - min_size;
 
-    fn get_last_filled(&self) -> Option<usize> {
-        self.cells
-            .iter()
-            .enumerate()
-            .filter(|(_, &v)| v == Filled)
-            .map(|(idx, _)| idx)
-            .last()
+        let known = match self.masks {
+            Some((filled, empty)) => (filled | empty).count_ones() as usize == size,
+            None => !self.cells.contains(&Unknown),
+        };
+        if known {
+            return if self.runs_match_hints() { Some(Vec::new()) } else { None };
+        }
+
+        if let Some((_, empty)) = self.masks {
+            self.solve_placements(buffers, &EmptyMask(empty), slack)
+        } else if fits_word(self.cells) {
+            self.solve_placements(buffers, &EmptyMask::new(self.cells), slack)
+        } else {
+            let empties = EmptyCounts::new(self.cells, mem::take(&mut buffers.empty_counts));
+            let result = self.solve_placements(buffers, &empties, slack);
+            buffers.empty_counts = empties.0;
+            result
+        }
     }
 
-    fn do_solve(&mut self) -> Option<Vec<Assumption>> {
-        let mut last_filled = self.get_last_filled();
-        if !self.verify(last_filled) {
+    /// A cell can be empty if some placement leaves it uncovered, and filled if some placement covers it by a hint;
+    /// both are decided from the head and tail tables in a single pass over the line.
+    fn solve_placements<E: EmptyCells>(
+        &self,
+        buffers: &mut LineBuffers,
+        empties: &E,
+        slack: usize,
+    ) -> Option<Vec<LineChange>> {
+        let size = self.cells.len();
+        let nhints = self.hints.len();
+        let width = nhints + 1;
+        let LineBuffers { head, tail, starts, coverage, .. } = buffers;
+
+        reset(head, (size + 1) * width, false);
+        if !self.fill_head(head, empties) {
             return None;
         }
-        let mut result = Vec::new();
-        'idxs: for idx in 0..self.cells.len() {
-            if self.cells[idx] != Unknown {
-                continue;
-            }
+        reset(tail, (size + 1) * width, false);
+        reset(starts, size * nhints, false);
+        self.fill_tail(tail, starts, empties);
 
-            for &val in KNOWN.iter() {
-                self.cells.to_mut()[idx] = val;
-                if !self.verify(match val {
-                    Filled => Some(opt_max(last_filled, idx)),
-                    _ => last_filled,
-                }) {
-                    let new_val = val.invert();
-                    self.cells.to_mut()[idx] = new_val;
-                    result.push(Assumption { coords: self.get_coords(idx), val: new_val });
-                    if new_val == Filled {
-                        last_filled = Some(opt_max(last_filled, idx));
-                    }
-                    continue 'idxs;
+        // Placements covering a cell are counted as +1 at the hint start and -1 at its end.
+        reset(coverage, size + 1, 0);
+        let mut min_start = 0;
+        for (j, &hint) in self.hints.iter().enumerate() {
+            for start in min_start..=min_start + slack {
+                let fits_before = if start == 0 {
+                    j == 0
+                } else {
+                    self.cells[start - 1] != Filled && head[(start - 1) * width + j]
+                };
+                if fits_before && starts[start * nhints + j] {
+                    coverage[start] += 1;
+                    coverage[start + hint] -= 1;
                 }
             }
+            min_start += hint + 1;
+        }
 
-            self.cells.to_mut()[idx] = Unknown;
+        let mut result = Vec::new();
+        let mut covered = 0;
+        for (idx, &val) in self.cells.iter().enumerate() {
+            covered += coverage[idx];
+            if val != Unknown {
+                continue;
+            }
+            let can_be_empty = (0..=nhints).any(|j| head[idx * width + j] && tail[(idx + 1) * width + j]);
+            if covered == 0 {
+                result.push((idx, Empty));
+            } else if !can_be_empty {
+                result.push((idx, Filled));
+            }
         }
-        debug_assert!(self.verify(last_filled));
         Some(result)
     }
 
+    /// Returns the cached solution of the line, if any.
+    pub fn cached<S: BuildHasher>(&self, cache: &LineCache<S>) -> Option<LineSolution> {
+        cache.borrow().get(&self.key()).cloned()
+    }
+
+    /// Caches the solution found by `do_solve`.
+    pub fn store<S: BuildHasher>(&self, cache: &LineCache<S>, result: Option<Vec<LineChange>>) -> LineSolution {
+        cache.borrow_mut().entry(self.key()).or_insert(Rc::new(result)).clone()
+    }
+
     /// Solves the line to the extent currently possbile.
     ///
-    /// Returns updates as a list of Assumption if the line wasn't controversial, None otherwise.
-    pub fn solve<S>(&mut self, cache: &LineCache<S>) -> LineSolution
-    where
-        S: BuildHasher,
-    {
-        let entry = cache.borrow().get(self.cells.as_ref()).map(|x| x.clone());
-        match entry {
-            Some(result) => result.clone(),
-            None => {
-                let key = Vec::from(self.cells.as_ref());
-                let result = self.do_solve();
-                cache.borrow_mut().entry(key).or_insert(Rc::new(result)).clone()
-            }
+    /// Returns updates as a list of LineChange if the line wasn't controversial, None otherwise.
+    pub fn solve<S: BuildHasher>(&self, cache: &LineCache<S>, buffers: &mut LineBuffers) -> LineSolution {
+        self.cached(cache)
+            .unwrap_or_else(|| self.store(cache, self.do_solve(buffers)))
+    }
+}
+
+/// Scratch space for solving lines, kept between the calls to avoid allocations.
+#[derive(Default)]
+pub struct LineBuffers {
+    head: Vec<bool>,
+    tail: Vec<bool>,
+    starts: Vec<bool>,
+    coverage: Vec<isize>,
+    empty_counts: Vec<usize>,
+}
+
+/// Line state as used for the line cache keys.
+#[derive(Hash, Eq, PartialEq)]
+pub enum LineKey {
+    /// Filled and empty cells as bit masks; used for lines that fit into a word.
+    Masks(u64, u64),
+    /// The same masks for every word-sized chunk of a longer line, which takes two bits per cell.
+    Words(Vec<u64>),
+}
+
+impl LineKey {
+    fn new(cells: &[CellValue]) -> Self {
+        if fits_word(cells) {
+            LineKey::Masks(cells_mask(cells, Filled), cells_mask(cells, Empty))
+        } else {
+            let words = cells
+                .chunks(u64::BITS as usize)
+                .flat_map(|chunk| [cells_mask(chunk, Filled), cells_mask(chunk, Empty)]);
+            LineKey::Words(words.collect())
         }
     }
 }
 
-fn opt_max<T: Ord + Copy>(a: Option<T>, b: T) -> T {
-    a.map_or(b, |v| v.max(b))
+/// Tells in constant time if there are empty cells in a range of the line.
+///
+/// The line solving code is generic over it, so that it's compiled separately for short and long lines.
+trait EmptyCells {
+    fn any_in(&self, start: usize, end: usize) -> bool;
+}
+
+/// Bit `i` is set if cell `i` is empty; used for lines that fit into a word.
+struct EmptyMask(u64);
+
+impl EmptyMask {
+    fn new(cells: &[CellValue]) -> Self {
+        Self(cells_mask(cells, Empty))
+    }
+}
+
+impl EmptyCells for EmptyMask {
+    fn any_in(&self, start: usize, end: usize) -> bool {
+        start < end && self.0 >> start & u64::MAX >> (u64::BITS as usize - (end - start)) != 0
+    }
+}
+
+/// `counts[i]` is the number of empty cells among the first `i` ones; used for longer lines.
+struct EmptyCounts(Vec<usize>);
+
+impl EmptyCounts {
+    /// Counts the empty cells into `counts`, reusing its allocation.
+    fn new(cells: &[CellValue], mut counts: Vec<usize>) -> Self {
+        reset(&mut counts, cells.len() + 1, 0);
+        for (idx, &val) in cells.iter().enumerate() {
+            counts[idx + 1] = counts[idx] + (val == Empty) as usize;
+        }
+        Self(counts)
+    }
+}
+
+impl EmptyCells for EmptyCounts {
+    fn any_in(&self, start: usize, end: usize) -> bool {
+        start < end && self.0[end] != self.0[start]
+    }
+}
+
+/// Sets bit `i` of the result if cell `i` has the given value; the cells must fit into a word.
+fn cells_mask(cells: &[CellValue], val: CellValue) -> u64 {
+    cells.iter().rev().fold(0, |mask, &x| mask << 1 | (x == val) as u64)
+}
+
+/// Compares the runs of set bits in `filled` with the hints, skipping a whole run or gap per step.
+fn mask_runs_match_hints(mut filled: u64, hints: &LineHints) -> bool {
+    for &hint in hints {
+        if filled == 0 {
+            return false;
+        }
+        filled >>= filled.trailing_zeros();
+        let run = filled.trailing_ones();
+        if run as usize != hint {
+            return false;
+        }
+        filled = filled.checked_shr(run).unwrap_or(0);
+    }
+    filled == 0
+}
+
+fn reset<T: Clone>(buf: &mut Vec<T>, len: usize, val: T) {
+    buf.clear();
+    buf.resize(len, val);
+}
+
+fn fits_word(cells: &[CellValue]) -> bool {
+    cells.len() <= u64::BITS as usize
 }
@@ -22,7 +22,7 @@ impl OwnedLine {
     }
 
     fn line(&self) -> Line {
-        Line::new(Row, 0, &self.hints, &self.cells)
+        Line::new(&self.hints, &self.cells)
     }
 }
 
@@ -42,94 +42,149 @@ fn serialization_fails() {
 #[test]
 fn verify_plenty_space() {
     let ol = OwnedLine::create(vec![2, 3], "~~~~~~").unwrap();
-    assert!(ol.line().verify(ol.line().get_last_filled()));
+    assert!(ol.line().verify());
 }
 
 #[test]
 fn verify_not_enough_space() {
     let ol = OwnedLine::create(vec![2, 3], "~~~~~").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_separated_enough_space() {
     let ol = OwnedLine::create(vec![2, 3], ".~~.~#~.").unwrap();
-    assert!(ol.line().verify(ol.line().get_last_filled()));
+    assert!(ol.line().verify());
 }
 
 #[test]
 fn verify_separated_not_enough_space() {
     let ol = OwnedLine::create(vec![2, 3], ".~~.#~.").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_unsatisfialble_filled() {
     let ol = OwnedLine::create(vec![2, 3], "~~#~~~").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_unsatisfialble_filled_with_frame() {
     let ol = OwnedLine::create(vec![2, 3], ".~~#~~~.").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_split_with_badly_filled_left() {
     let ol = OwnedLine::create(vec![2, 3], "#~~#.~~~").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_too_many_filled() {
     let ol = OwnedLine::create(vec![2, 3], "#~~.~#~.#").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
 }
 
 #[test]
 fn verify_split_with_fine_left() {
     let ol = OwnedLine::create(vec![2, 3], "#~~#.~~").unwrap();
-    assert!(!ol.line().verify(ol.line().get_last_filled()));
+    assert!(!ol.line().verify());
+}
+
+#[test]
+fn verify_no_hints_with_filled() {
+    let ol = OwnedLine::create(vec![], "~~#~").unwrap();
+    assert!(!ol.line().verify());
+}
+
+#[test]
+fn verify_longer_than_word() {
+    let cells = format!("{}~.~#.", ".".repeat(64));
+    assert!(OwnedLine::create(vec![2], &cells).unwrap().line().verify());
+    assert!(!OwnedLine::create(vec![3], &cells).unwrap().line().verify());
 }
 
 #[test]
 fn solve_simple_overlap_and_unreachable() {
     let ol = OwnedLine::create(vec![4], "~~~~~#~~").unwrap();
     let cache = RefCell::new(HashMap::new());
-    let result = ol.line().solve(&cache).clone();
-    let changes: HashSet<&Assumption> = result.iter().flat_map(|x| x.iter()).collect();
-    assert_eq!(
-        changes,
-        HashSet::from([
-            &Assumption { coords: (0, 0), val: Empty },
-            &Assumption { coords: (0, 1), val: Empty },
-            &Assumption { coords: (0, 4), val: Filled },
-        ])
-    );
+    let result = ol.line().solve(&cache, &mut LineBuffers::default()).clone();
+    let changes: HashSet<&LineChange> = result.iter().flat_map(|x| x.iter()).collect();
+    assert_eq!(changes, HashSet::from([&(0, Empty), &(1, Empty), &(4, Filled)]));
 }
 
 #[test]
 fn solve_fill_with_ambiguity() {
     let ol = OwnedLine::create(vec![1, 2], "~~~#.~~").unwrap();
     let cache = RefCell::new(HashMap::new());
-    let result = ol.line().solve(&cache).clone();
-    let changes: HashSet<&Assumption> = result.iter().flat_map(|x| x.iter()).collect();
-    assert_eq!(changes, HashSet::from([&Assumption { coords: (0, 1), val: Empty },]));
+    let result = ol.line().solve(&cache, &mut LineBuffers::default()).clone();
+    let changes: HashSet<&LineChange> = result.iter().flat_map(|x| x.iter()).collect();
+    assert_eq!(changes, HashSet::from([&(1, Empty)]));
 }
 
 #[test]
 fn solve_empties_with_definite_chunks() {
     let ol = OwnedLine::create(vec![2, 1], "~~~.~#~.#").unwrap();
     let cache = RefCell::new(HashMap::new());
-    let result = ol.line().solve(&cache).clone();
-    let changes: HashSet<&Assumption> = result.iter().flat_map(|x| x.iter()).collect();
-    assert_eq!(
-        changes,
-        HashSet::from([
-            &Assumption { coords: (0, 0), val: Empty },
-            &Assumption { coords: (0, 1), val: Empty },
-            &Assumption { coords: (0, 2), val: Empty },
-        ])
-    );
+    let result = ol.line().solve(&cache, &mut LineBuffers::default()).clone();
+    let changes: HashSet<&LineChange> = result.iter().flat_map(|x| x.iter()).collect();
+    assert_eq!(changes, HashSet::from([&(0, Empty), &(1, Empty), &(2, Empty)]));
+}
+
+#[test]
+fn solve_known_line() {
+    let cache = RefCell::new(HashMap::new());
+    let ol = OwnedLine::create(vec![2, 1], "##..#").unwrap();
+    assert_eq!(*ol.line().solve(&cache, &mut LineBuffers::default()), Some(vec![]));
+    let ol = OwnedLine::create(vec![2, 1], "##.##").unwrap();
+    assert_eq!(*ol.line().solve(&cache, &mut LineBuffers::default()), None);
+}
+
+#[test]
+fn solve_longer_than_word() {
+    let longer = OwnedLine::create(vec![5], &format!("{}~~~~#~~~~~~", ".".repeat(64))).unwrap();
+    let shorter = OwnedLine::create(vec![5], &format!("{}~~~~#~~~", ".".repeat(64))).unwrap();
+    // The buffers are shared by lines of different lengths, so they have to be resized both ways
+    let mut buffers = LineBuffers::default();
+    for (ol, expected) in [
+        (&shorter, vec![(67, Filled)]),
+        (&longer, vec![(73, Empty), (74, Empty)]),
+        (&shorter, vec![(67, Filled)]),
+    ] {
+        let result = ol.line().solve(&RefCell::new(HashMap::new()), &mut buffers);
+        assert_eq!(*result, Some(expected));
+    }
+}
+
+#[test]
+fn cache_longer_than_word() {
+    let cache = RefCell::new(HashMap::new());
+    let mut buffers = LineBuffers::default();
+    let ol = OwnedLine::create(vec![3], &format!("{}~~#~~", ".".repeat(64))).unwrap();
+    assert!(matches!(ol.line().key(), LineKey::Words(_)));
+    let solution = ol.line().solve(&cache, &mut buffers);
+    assert!(Rc::ptr_eq(&ol.line().solve(&cache, &mut buffers), &solution));
+    // Differs from the first line only in the second word of the key
+    let other = OwnedLine::create(vec![3], &format!("{}~#~~~", ".".repeat(64))).unwrap();
+    assert!(other.line().cached(&cache).is_none());
+    assert!(!Rc::ptr_eq(&other.line().solve(&cache, &mut buffers), &solution));
+    assert_eq!(cache.borrow().len(), 2);
+}
+
+fn solve_with_masks(ol: &OwnedLine) -> LineSolution {
+    let masks = (cells_mask(&ol.cells, Filled), cells_mask(&ol.cells, Empty));
+    let line = ol.line().with_masks(Some(masks));
+    line.solve(&RefCell::new(HashMap::new()), &mut LineBuffers::default())
+}
+
+#[test]
+fn solve_known_line_with_masks() {
+    let ol = OwnedLine::create(vec![2, 1], "##..#").unwrap();
+    assert_eq!(*solve_with_masks(&ol), Some(vec![]));
+    let ol = OwnedLine::create(vec![2, 1], "##.##").unwrap();
+    assert_eq!(*solve_with_masks(&ol), None);
+    let ol = OwnedLine::create(vec![1], "...").unwrap();
+    assert_eq!(*solve_with_masks(&ol), None);
 }
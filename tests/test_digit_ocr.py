@@ -0,0 +1,51 @@
+import os.path
+import unittest
+from itertools import product
+
+try:
+    import cv2
+    import numpy as np
+    from ocr.katana_source import DigitOCR, Rect, extract_rect, get_contour_rects
+except ImportError:
+    cv2 = None
+
+
+DIGITS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "ocr", "digits.png")
+
+STROKE_CHANGES = (-1, 0, 1)
+# Width and height scales of the glyphs, changing their aspect ratio by at most 0.8..1.25
+SCALES = [
+    (x_scale, y_scale)
+    for x_scale, y_scale in product((0.8, 0.9, 1, 1.1, 1.25), repeat=2)
+    if 0.8 <= x_scale / y_scale <= 1.25
+]
+
+
+def distort(glyph: "np.ndarray", stroke_change: int, x_scale: float, y_scale: float) -> "np.ndarray":
+    img = cv2.copyMakeBorder(glyph, 2, 2, 2, 2, cv2.BORDER_CONSTANT, value=0)
+    kernel = np.ones((2, 2), np.uint8)
+    if stroke_change > 0:
+        img = cv2.dilate(img, kernel)
+    elif stroke_change < 0:
+        img = cv2.erode(img, kernel)
+    h, w = img.shape
+    img = cv2.resize(img, (round(w * x_scale), round(h * y_scale)))
+    _, img = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
+    return extract_rect(img, Rect(*cv2.boundingRect(img)))
+
+
+@unittest.skipIf(cv2 is None, "OpenCV is not installed")
+class DigitOCRTest(unittest.TestCase):
+
+    def test_recognizes_distorted_sample_digits(self):
+        ocr = DigitOCR(DIGITS_PATH)
+        _, digits_img = cv2.threshold(ocr.digits_img, 127, 255, cv2.THRESH_BINARY)
+        rects = sorted(get_contour_rects(digits_img), key=lambda r: r.x)
+        misread = []
+        for digit, rect in enumerate(rects):
+            glyph = extract_rect(digits_img, rect)
+            for stroke_change, (x_scale, y_scale) in product(STROKE_CHANGES, SCALES):
+                result = ocr.recognize(distort(glyph, stroke_change, x_scale, y_scale))
+                if result != digit:
+                    misread.append((digit, stroke_change, x_scale, y_scale, result))
+        self.assertEqual(misread, [])